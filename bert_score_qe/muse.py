@@ -1,118 +1,240 @@
+import array
 import io
 import numpy as np
-import re
 import os
+import pickle
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import torch
+except ImportError:
+    torch = None
 
 """class MuseTokenizer:
     def __init__(self, emb_path, nmax=50000): 
-        self.embeddings, self.id2word, self.word2id = load_vec(src_path, nmax)
+        self.embeddings, self.id2word, self.word2id = load_vec(src_path, nmax, build_id2word=True)
         self.pad_token_id = 0 """
 
-def load_vec(emb_path, nmax=50000):
-    vectors = []
+# punctuation stripped from every token in read_corpus
+_PUNCT = str.maketrans('', '', '",.:!?()')
+
+def _parse_vectors(block, dim, dtype):
+    # parse the text of many vectors with a single np.fromstring call
+    return np.fromstring(' '.join(block), sep=' ', dtype=dtype).reshape(len(block), dim)
+
+def load_vec(emb_path, nmax=50000, dtype=np.float32, build_id2word=False, block_size=10000):
     word2id = {}
     with io.open(emb_path, 'r', encoding='utf-8', newline='\n', errors='ignore') as f:
-        next(f)
-        for i, line in enumerate(f):
+        # the header holds the number of words and the dimension
+        n, dim = map(int, next(f).split())
+        embeddings = np.empty((min(nmax, n), dim), dtype=dtype)
+        block = []
+        for line in f:
             word, vect = line.rstrip().split(' ', 1)
-            vect = np.fromstring(vect, sep=' ')
             assert word not in word2id, 'word found twice'
-            vectors.append(vect)
             word2id[word] = len(word2id)
-            if len(word2id) % 10000 == 0:
-                print(len(word2id))
-            if len(word2id) == nmax:
+            block.append(vect)
+            if len(block) == block_size or len(word2id) == len(embeddings):
+                embeddings[len(word2id) - len(block):len(word2id)] = _parse_vectors(block, dim, dtype)
+                block = []
+            if len(word2id) == len(embeddings):
                 break
+        if len(block) > 0:
+            embeddings[len(word2id) - len(block):len(word2id)] = _parse_vectors(block, dim, dtype)
+    embeddings = embeddings[:len(word2id)]
+    if not build_id2word:
+        return embeddings, word2id
     id2word = {v: k for k, v in word2id.items()}
-    embeddings = np.vstack(vectors)
     return embeddings, id2word, word2id
 
-def read_corpus(file_path, word2id, embeddings):
-    sentences = []
-    for line in open(file_path, encoding='utf-8'):
-        sent = line.strip().split(' ')
-        vectors_sent = []
-        for word in sent:
-            word = word.lower()
-            """if len(word) == 0:
-                continue
-            if word[0] == '\"':
-                word = word[1:]
-            if len(word) == 0:
-                continue
-            if word[-1] == '.':
-                word = word[:-1]"""
-            word = re.sub('[\",.:!?()]', '', word)
-            if "-" in word:
-                subwords = word.split('-')
-            else:
-                subwords = [word]
-            for subword in subwords:
-                if subword not in word2id:
-                    #print(word)
+def load_vec_cached(emb_path, nmax=50000):
+    # row-normalized float32 embeddings; the .vec text is parsed on the first run only,
+    # later runs memory-map the .npy copy. The cache name includes the size and mtime of
+    # the .vec file, so a regenerated .vec file is parsed again instead of shadowed.
+    stat = os.stat(emb_path)
+    cache_path = '%s.%d.%d.%d' % (emb_path, nmax, stat.st_size, stat.st_mtime_ns)
+    if not os.path.exists(cache_path + '.npy'):
+        embeddings, word2id = load_vec(emb_path, nmax)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        # write to temporary names and rename them into place, so an interrupted run
+        # never leaves a truncated cache file behind; the .npy is renamed last, so an
+        # existing .npy means the cache is complete
+        tmp_suffix = '.tmp%d' % os.getpid()
+        with open(cache_path + '.pkl' + tmp_suffix, 'wb') as f:
+            pickle.dump(word2id, f)
+        os.replace(cache_path + '.pkl' + tmp_suffix, cache_path + '.pkl')
+        with open(cache_path + '.npy' + tmp_suffix, 'wb') as f:
+            np.save(f, np.ascontiguousarray(embeddings))
+        os.replace(cache_path + '.npy' + tmp_suffix, cache_path + '.npy')
+    with open(cache_path + '.pkl', 'rb') as f:
+        word2id = pickle.load(f)
+    embeddings = np.load(cache_path + '.npy', mmap_mode='r')
+    return embeddings, word2id
+
+def read_corpus(file_path, word2id):
+    # the word ids of all sentences back to back, sentence i is ids[offsets[i]:offsets[i + 1]]
+    ids = array.array('i')
+    offsets = [0]
+    # a 1MB read buffer instead of the 8KB default means far fewer read calls on large corpora
+    with open(file_path, encoding='utf-8', buffering=1 << 20) as f:
+        for line in f:
+            sent = line.strip().split(' ')
+            for word in sent:
+                word = word.lower()
+                """if len(word) == 0:
                     continue
-                index = word2id[subword]
-                vect = embeddings[index]
-                vectors_sent.append(vect)
-        """if len(sentences) == 1:
-            print(len(vectors_sent))"""
-        sentences.append(vectors_sent)
-    return sentences
+                if word[0] == '\"':
+                    word = word[1:]
+                if len(word) == 0:
+                    continue
+                if word[-1] == '.':
+                    word = word[:-1]"""
+                word = word.translate(_PUNCT)
+                for subword in word.split('-'):
+                    index = word2id.get(subword)
+                    if index is None:
+                        #print(word)
+                        continue
+                    ids.append(index)
+            offsets.append(len(ids))
+    return np.asarray(ids, dtype=np.int32), np.asarray(offsets, dtype=np.int64)
+
+def gather_vec(embeddings, ids):
+    # the (n_tokens, dim) float32 word vectors of a corpus, in one gather
+    return embeddings[ids].astype(np.float32)
+
+def _f1_scores(R, P, src_offsets, tgt_offsets):
+    # F1 of every sentence pair, pairs with no known word on either side score 1
+    valid = (np.diff(src_offsets) > 0) & (np.diff(tgt_offsets) > 0)
+    scores = np.ones(len(valid))
+    scores[valid] = 2 * P[valid] * R[valid] / (P[valid] + R[valid])
+    return scores
+
+def score_corpus(src_vecs, src_offsets, tgt_vecs, tgt_offsets):
+    # one small matmul per sentence pair, on slices of the contiguous corpus
+    # matrices, so only the (src_length, tgt_length) blocks that are used get computed
+    R = np.zeros(len(src_offsets) - 1)
+    P = np.zeros(len(src_offsets) - 1)
+    for i in range(len(src_offsets) - 1):
+        src_sent = src_vecs[src_offsets[i]:src_offsets[i + 1]]
+        tgt_sent = tgt_vecs[tgt_offsets[i]:tgt_offsets[i + 1]]
+        if len(src_sent) == 0 or len(tgt_sent) == 0:
+            continue
+        # Shape: (src_length, tgt_length)
+        sim = src_sent @ tgt_sent.T
+        # compute recall
+        R[i] = sim.max(axis=1).mean()
+        # compute precision
+        P[i] = sim.max(axis=0).mean()
+    return _f1_scores(R, P, src_offsets, tgt_offsets)
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True)
+    def _score_kernel(src_vecs, src_offsets, tgt_vecs, tgt_offsets):
+        # fused recall/precision: track the row and column maxima while scanning
+        # the dot products, without materializing the similarity matrix. The maxima
+        # start from -2, below any cosine of unit vectors; fastmath assumes no
+        # infinities, so -inf can't be used as the seed.
+        n = len(src_offsets) - 1
+        R = np.zeros(n)
+        P = np.zeros(n)
+        for k in numba.prange(n):
+            src_start, src_end = src_offsets[k], src_offsets[k + 1]
+            tgt_start, tgt_end = tgt_offsets[k], tgt_offsets[k + 1]
+            if src_end == src_start or tgt_end == tgt_start:
+                continue
+            col_max = np.full(tgt_end - tgt_start, -2.0)
+            row_sum = 0.0
+            for i in range(src_start, src_end):
+                row_max = -2.0
+                for j in range(tgt_start, tgt_end):
+                    dot = 0.0
+                    for d in range(src_vecs.shape[1]):
+                        dot += src_vecs[i, d] * tgt_vecs[j, d]
+                    if dot > row_max:
+                        row_max = dot
+                    if dot > col_max[j - tgt_start]:
+                        col_max[j - tgt_start] = dot
+                row_sum += row_max
+            R[k] = row_sum / (src_end - src_start)
+            P[k] = col_max.mean()
+        return R, P
+
+def score_corpus_numba(src_vecs, src_offsets, tgt_vecs, tgt_offsets):
+    # same scores as score_corpus, computed by a parallel numba kernel
+    if numba is None:
+        raise ImportError("score_corpus_numba requires numba, please install it")
+    R, P = _score_kernel(src_vecs, src_offsets, tgt_vecs, tgt_offsets)
+    return _f1_scores(R, P, src_offsets, tgt_offsets)
+
+def score_corpus_torch(src_vecs, src_offsets, tgt_vecs, tgt_offsets, device='cuda', bucket_size=64):
+    # same scores as score_corpus, computed with one torch.bmm per bucket of sentence
+    # pairs of similar lengths, padded to the longest pair in the bucket
+    if torch is None:
+        raise ImportError("score_corpus_torch requires torch, please install it")
+    src_lens = np.diff(src_offsets)
+    tgt_lens = np.diff(tgt_offsets)
+    R = np.zeros(len(src_lens))
+    P = np.zeros(len(src_lens))
+    valid = [i for i in range(len(src_lens)) if src_lens[i] > 0 and tgt_lens[i] > 0]
+    valid.sort(key=lambda i: (src_lens[i], tgt_lens[i]))
+    src_vecs = torch.from_numpy(src_vecs)
+    tgt_vecs = torch.from_numpy(tgt_vecs)
+    for start in range(0, len(valid), bucket_size):
+        bucket = valid[start:start + bucket_size]
+        src = torch.nn.utils.rnn.pad_sequence(
+            [src_vecs[src_offsets[i]:src_offsets[i + 1]] for i in bucket], batch_first=True).to(device)
+        tgt = torch.nn.utils.rnn.pad_sequence(
+            [tgt_vecs[tgt_offsets[i]:tgt_offsets[i + 1]] for i in bucket], batch_first=True).to(device)
+        bucket_src_lens = torch.from_numpy(src_lens[bucket]).to(device)
+        bucket_tgt_lens = torch.from_numpy(tgt_lens[bucket]).to(device)
+        # Shape: (bucket_size, max_src_length) and (bucket_size, max_tgt_length)
+        src_mask = torch.arange(src.size(1), device=device)[None, :] < bucket_src_lens[:, None]
+        tgt_mask = torch.arange(tgt.size(1), device=device)[None, :] < bucket_tgt_lens[:, None]
+
+        # Shape: (bucket_size, max_src_length, max_tgt_length)
+        sim = torch.bmm(src, tgt.transpose(1, 2))
+        # compute recall, padded tgt words never win the max and padded src rows are ignored
+        row_max = sim.masked_fill(~tgt_mask[:, None, :], -float('inf')).max(dim=2)[0]
+        R[bucket] = (row_max.masked_fill(~src_mask, 0).sum(dim=1) / bucket_src_lens).cpu().numpy()
+        # compute precision
+        col_max = sim.masked_fill(~src_mask[:, :, None], -float('inf')).max(dim=1)[0]
+        P[bucket] = (col_max.masked_fill(~tgt_mask, 0).sum(dim=1) / bucket_tgt_lens).cpu().numpy()
+    return _f1_scores(R, P, src_offsets, tgt_offsets)
 
 def main():
     src_vec_path = 'E:/Projects/wiki.multi.de.vec'
     tgt_vec_path = 'E:/Projects/wiki.multi.en.vec'
     nmax = 150000  # maximum number of word embeddings to load
+    use_numba = False  # score with the numba kernel instead of BLAS
+    use_torch = False  # score bucketed sentence pairs with torch.bmm on the GPU
 
-    src_embeddings, src_id2word, src_word2id = load_vec(src_vec_path, nmax)
-    tgt_embeddings, tgt_id2word, tgt_word2id = load_vec(tgt_vec_path, nmax)
+    # normalized, so that the dot product of two word vectors is their cosine
+    src_embeddings, src_word2id = load_vec_cached(src_vec_path, nmax)
+    tgt_embeddings, tgt_word2id = load_vec_cached(tgt_vec_path, nmax)
     #print(src_word2id)
 
     src_path = './newstest2019-deen-src.de'
-    src_sentences = read_corpus(src_path, src_word2id, src_embeddings)
+    src_ids, src_offsets = read_corpus(src_path, src_word2id)
+    src_vecs = gather_vec(src_embeddings, src_ids)
     tgts = os.listdir("./de-en/")
     for system in tgts:
         tgt_path = './de-en/' + system
-        tgt_sentences = read_corpus(tgt_path, tgt_word2id, tgt_embeddings)
+        tgt_ids, tgt_offsets = read_corpus(tgt_path, tgt_word2id)
+        tgt_vecs = gather_vec(tgt_embeddings, tgt_ids)
     
-        scores = []
-        for i in range(len(src_sentences)):
-            src_sent = src_sentences[i]
-            tgt_sent = tgt_sentences[i]
-            if len(src_sent) == 0 or len(tgt_sent) == 0:
-                #print(i)
-                scores.append(1)
-                continue
+        if use_numba:
+            scores = score_corpus_numba(src_vecs, src_offsets, tgt_vecs, tgt_offsets)
+        elif use_torch:
+            scores = score_corpus_torch(src_vecs, src_offsets, tgt_vecs, tgt_offsets)
+        else:
+            scores = score_corpus(src_vecs, src_offsets, tgt_vecs, tgt_offsets)
 
-            # compute recall
-            cur_sum = 0
-            for src_wrd in src_sent:
-                cur_max = -2
-                for tgt_wrd in tgt_sent:
-                    cur = np.dot(src_wrd, tgt_wrd)
-                    if cur > cur_max:
-                        cur_max = cur
-                cur_sum += cur_max
-            R = cur_sum / len(src_sent)
-            #print(R)
-
-            # compute precision
-            cur_sum = 0
-            for tgt_wrd in tgt_sent:
-                cur_max = -2
-                for src_wrd in src_sent:
-                    cur = np.dot(src_wrd, tgt_wrd)
-                    if cur > cur_max:
-                        cur_max = cur
-                cur_sum += cur_max
-            P = cur_sum / len(tgt_sent)
-
-            # compute F1
-            F = 2 * P * R / (P + R)
-            #print("%.5f, %.5f %.5f" % (R, P, F))
-            scores.append(F)
-
-        avg = sum(scores) / len(scores)
+        avg = scores.mean()
         print("%s: %.7f" % (system, avg))
         #print(avg)
 
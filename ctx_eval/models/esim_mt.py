@@ -1,18 +1,39 @@
-from typing import Dict, Optional, List, Any
+from typing import Dict, Optional, List, Any, Tuple
+import contextlib
+import math
+import re
 
 import torch
 
-from allennlp.common.checks import check_dimensions_match
+from allennlp.common.checks import check_dimensions_match, ConfigurationError
 from allennlp.data import Vocabulary
 from allennlp.models.model import Model
 from allennlp.modules import FeedForward, InputVariationalDropout
 from allennlp.modules.matrix_attention.legacy_matrix_attention import LegacyMatrixAttention
 from allennlp.modules import Seq2SeqEncoder, SimilarityFunction, TextFieldEmbedder
+from allennlp.modules.similarity_functions import DotProductSimilarity
 from allennlp.nn import InitializerApplicator, RegularizerApplicator
-from allennlp.nn.util import get_text_field_mask, masked_softmax, weighted_sum, replace_masked_values
+from allennlp.nn.util import get_text_field_mask, masked_softmax, weighted_sum
 from allennlp.training.metrics import PearsonCorrelation
 
 
+# ``scaled_dot_product_attention`` exists since PyTorch 2.0, but its ``scale`` argument only
+# since 2.1.
+_TORCH_VERSION = tuple(int(part) for part in re.match(r"(\d+)\.(\d+)", torch.__version__).groups())
+_HAS_SCALED_DOT_PRODUCT_ATTENTION = _TORCH_VERSION >= (2, 1)
+
+
+@torch.jit.script
+def _masked_max_avg_pool(values: torch.Tensor, mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Max and average pooling of ``values`` (batch_size, length, dim) over the positions where
+    ``mask`` (batch_size, length, 1) is one, scripted so the masking and reductions are fused.
+    """
+    max_pooled = values.masked_fill(mask == 0, -1e7).max(dim=1)[0]
+    avg_pooled = (values * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+    return max_pooled, avg_pooled
+
+
 @Model.register("esim_mt")
 class ESIM(Model):
     """
@@ -42,6 +63,12 @@ class ESIM(Model):
 	legacy input that does nothing
     dropout : ``float``, optional (default=0.5)
         Dropout percentage to use.
+    mixed_precision : ``bool``, optional (default=False)
+        If true, the encoders, attention and projection run under bfloat16 autocast on GPU.
+        The loss and metric are still computed in float32.
+    compile_forward : ``bool``, optional (default=False)
+        If true, everything after the embedding lookup is compiled with ``torch.compile``, which
+        fuses the many small elementwise ops of the model into fewer kernels.
     initializer : ``InitializerApplicator``, optional (default=``InitializerApplicator()``)
         Used to initialize the model parameters.
     regularizer : ``RegularizerApplicator``, optional (default=``None``)
@@ -56,6 +83,8 @@ class ESIM(Model):
                  output_feedforward: FeedForward,
                  output_logit: FeedForward,
                  dropout: float = 0.5,
+                 mixed_precision: bool = False,
+                 compile_forward: bool = False,
                  initializer: InitializerApplicator = InitializerApplicator(),
                  regularizer: Optional[RegularizerApplicator] = None) -> None:
         super().__init__(vocab, regularizer)
@@ -63,7 +92,16 @@ class ESIM(Model):
         self._text_field_embedder = text_field_embedder
         self._encoder = encoder
 
-        self._matrix_attention = LegacyMatrixAttention(similarity_function)
+        # A dot product similarity is computed directly with one batched matmul, other
+        # similarity functions go through the (slower) legacy matrix attention.
+        if isinstance(similarity_function, DotProductSimilarity):
+            self._matrix_attention = None
+            self._scale_similarity = similarity_function._scale_output  # pylint: disable=protected-access
+        else:
+            self._matrix_attention = LegacyMatrixAttention(similarity_function)
+        # With a dot product similarity, PyTorch's fused scaled_dot_product_attention
+        # replaces the similarity matrix, masked softmax and weighted sum.
+        self._fused_attention = self._matrix_attention is None and _HAS_SCALED_DOT_PRODUCT_ATTENTION
         self._projection_feedforward = projection_feedforward
 
         self._inference_encoder = inference_encoder
@@ -79,6 +117,20 @@ class ESIM(Model):
 
         self._num_labels = 1
 
+        if mixed_precision and not hasattr(torch, "autocast"):
+            raise ConfigurationError("mixed_precision requires a PyTorch version with torch.autocast")
+        self._mixed_precision = mixed_precision
+        if compile_forward and not hasattr(torch, "compile"):
+            raise ConfigurationError("compile_forward requires a PyTorch version with torch.compile")
+        # Only tensors go in and out of _predict, so the dict inputs and outputs of forward do
+        # not trigger recompilation; sequence lengths are marked dynamic for the same reason.
+        # The unbound function is compiled and called with the module as its first argument,
+        # so DataParallel replicas (which copy ``__dict__``) run it on their own parameters.
+        if compile_forward:
+            self._compiled_predict = torch.compile(ESIM._predict, mode="reduce-overhead", dynamic=True)
+        else:
+            self._compiled_predict = None
+
         check_dimensions_match(text_field_embedder.get_output_dim(), encoder.get_input_dim(),
                                "text field embedding dim", "encoder input dim")
         check_dimensions_match(encoder.get_output_dim() * 4, projection_feedforward.get_input_dim(),
@@ -120,6 +172,37 @@ class ESIM(Model):
         mtref_mask = get_text_field_mask(ref).float()
         mtsys_mask = get_text_field_mask(mt).float()
 
+        with self._autocast(embedded_mtref.is_cuda):
+            if self._compiled_predict is not None:
+                pred = self._compiled_predict(self, embedded_mtref, embedded_mtsys, mtref_mask, mtsys_mask)
+            else:
+                pred = self._predict(embedded_mtref, embedded_mtsys, mtref_mask, mtsys_mask)
+        # the loss and metric are computed in float32
+        pred = pred.float()
+
+        output_dict = {'pred': pred}
+
+        if score is not None:
+            loss = self._loss(pred, score)
+            self._metric(pred, score)
+            output_dict["loss"] = loss
+
+        return output_dict
+
+
+    def _predict(self,
+                 embedded_mtref: torch.Tensor,
+                 embedded_mtsys: torch.Tensor,
+                 mtref_mask: torch.Tensor,
+                 mtsys_mask: torch.Tensor) -> torch.Tensor:
+        """
+        Runs the encoders, attention, enhancement, inference and pooling layers on the embedded
+        mtref and mtsys and returns the predicted scores, of shape (batch_size, 1).
+        """
+        # Shape: (batch_size, mtref/sys_length, 1)
+        mtref_mask_3d = mtref_mask.unsqueeze(-1)
+        mtsys_mask_3d = mtsys_mask.unsqueeze(-1)
+
         # apply dropout for LSTM
         if self.rnn_input_dropout:
             embedded_mtref = self.rnn_input_dropout(embedded_mtref)
@@ -128,68 +211,34 @@ class ESIM(Model):
         # encode mtref and mtsys
 
         # Shape: (batch_size, mtref/sys_length, modeldim*2 =600)
-        encoded_mtref = self._encoder(embedded_mtref, mtref_mask)
-        encoded_mtsys = self._encoder(embedded_mtsys, mtsys_mask)
-
-        # Shape: (batch_size, mtref_length, mtsys_length)
-        similarity_matrix = self._matrix_attention(encoded_mtref, encoded_mtsys)
-
-        # Shape: (batch_size, mtref_length, mtsys_length)
-        p2h_attention = masked_softmax(similarity_matrix, mtsys_mask)
-        # Shape: (batch_size, mtref_length, embedding_dim)
-        attended_mtsys = weighted_sum(encoded_mtsys, p2h_attention)
+        encoded_mtref, encoded_mtsys = self._encode_pair(self._encoder, embedded_mtref, embedded_mtsys,
+                                                         mtref_mask, mtsys_mask)
 
-        # Shape: (batch_size, mtsys_length, mtref_length)
-        h2p_attention = masked_softmax(similarity_matrix.transpose(1, 2).contiguous(), mtref_mask)
-        # Shape: (batch_size, mtsys_length, embedding_dim)
-        attended_mtref = weighted_sum(encoded_mtref, h2p_attention)
+        # Shape: (batch_size, mtref/sys_length, embedding_dim)
+        attended_mtsys, attended_mtref = self._attend(encoded_mtref, encoded_mtsys,
+                                                      mtref_mask, mtsys_mask, mtref_mask_3d)
 
-        # the "enhancement" layer
-        # Shape: (batch_size, mtref/sys_length, modeldim *2 * 4=2400)
-        mtref_enhanced = torch.cat(
-                [encoded_mtref, attended_mtsys,
-                 encoded_mtref - attended_mtsys,
-                 encoded_mtref * attended_mtsys],
-                dim=-1
-        )
-        mtsys_enhanced = torch.cat(
-                [encoded_mtsys, attended_mtref,
-                 encoded_mtsys - attended_mtref,
-                 encoded_mtsys * attended_mtref],
-                dim=-1
-        )
-
-        # The projection layer down to the model dimension.  Dropout is not applied before
-        # projection.
+        # the "enhancement" layer, fused with the projection layer down to the model
+        # dimension so the 2400-wide concatenation is never materialized.  Dropout is
+        # not applied before projection.
 
         # Shape: (batch_size, mtref/sys_length, modeldim =300)
-        projected_enhanced_mtref = self._projection_feedforward(mtref_enhanced)
-        projected_enhanced_mtsys = self._projection_feedforward(mtsys_enhanced)
-
+        projected_enhanced_mtref = self._project_enhanced(encoded_mtref, attended_mtsys)
+        projected_enhanced_mtsys = self._project_enhanced(encoded_mtsys, attended_mtref)
 
         # Run the inference layer
         if self.rnn_input_dropout:
             projected_enhanced_mtref = self.rnn_input_dropout(projected_enhanced_mtref)
             projected_enhanced_mtsys = self.rnn_input_dropout(projected_enhanced_mtsys)
         # Shape: (batch_size, mtref/sys_length, modeldim*2 =600)
-        v_ai = self._inference_encoder(projected_enhanced_mtref, mtref_mask)
-        v_bi = self._inference_encoder(projected_enhanced_mtsys, mtsys_mask)
+        v_ai, v_bi = self._encode_pair(self._inference_encoder, projected_enhanced_mtref,
+                                       projected_enhanced_mtsys, mtref_mask, mtsys_mask)
 
         # The pooling layer -- max and avg pooling.
-        # (batch_size, model_dim*2 = 600)
-        v_a_max, _ = replace_masked_values(
-                v_ai, mtref_mask.unsqueeze(-1), -1e7
-        ).max(dim=1)
-        # (batch_size, model_dim * 2 = 600)
-        v_b_max, _ = replace_masked_values(
-                v_bi, mtsys_mask.unsqueeze(-1), -1e7
-        ).max(dim=1)
         # (batch_size, model_dim * 2 = 600)
-        v_a_avg = torch.sum(v_ai * mtref_mask.unsqueeze(-1), dim=1) / torch.sum(
-                mtref_mask, 1, keepdim=True)
+        v_a_max, v_a_avg = _masked_max_avg_pool(v_ai, mtref_mask_3d)
         # (batch_size, model_dim * 2 = 600)
-        v_b_avg = torch.sum(v_bi * mtsys_mask.unsqueeze(-1), dim=1) / torch.sum(
-                mtsys_mask, 1, keepdim=True)
+        v_b_max, v_b_avg = _masked_max_avg_pool(v_bi, mtsys_mask_3d)
 
         # Now concat
         # (batch_size, model_dim * 2 * 4)
@@ -200,16 +249,107 @@ class ESIM(Model):
             v_all = self.dropout(v_all)
 
         pred  = self._output_feedforward(v_all)
+        return pred
+
+    def _attend(self,
+                encoded_mtref: torch.Tensor,
+                encoded_mtsys: torch.Tensor,
+                mtref_mask: torch.Tensor,
+                mtsys_mask: torch.Tensor,
+                mtref_mask_3d: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Soft-aligns the encoded mtref and mtsys with each other, returning the attended mtsys for
+        every mtref word and the attended mtref for every mtsys word.
+        """
+        if self._fused_attention:
+            scale = math.sqrt(encoded_mtref.size(-1)) if self._scale_similarity else 1.0
+            # The fused kernel never materializes the (mtref_length, mtsys_length) attention.
+            # Shape: (batch_size, mtref_length, embedding_dim)
+            attended_mtsys = torch.nn.functional.scaled_dot_product_attention(
+                    encoded_mtref, encoded_mtsys, encoded_mtsys,
+                    attn_mask=mtsys_mask[:, None, :].bool(), scale=scale)
+            # Shape: (batch_size, mtsys_length, embedding_dim)
+            attended_mtref = torch.nn.functional.scaled_dot_product_attention(
+                    encoded_mtsys, encoded_mtref, encoded_mtref,
+                    attn_mask=mtref_mask[:, None, :].bool(), scale=scale)
+            # Before PyTorch 2.5 the fused kernel returns NaN when every key is masked (an
+            # empty mtref or mtsys); masked_softmax returns zeros there, so do the same.
+            attended_mtsys = attended_mtsys.masked_fill((mtsys_mask.sum(-1) == 0)[:, None, None], 0)
+            attended_mtref = attended_mtref.masked_fill((mtref_mask.sum(-1) == 0)[:, None, None], 0)
+            return attended_mtsys, attended_mtref
 
-        output_dict = {'pred': pred}
+        # Shape: (batch_size, mtref_length, mtsys_length)
+        if self._matrix_attention is None:
+            similarity_matrix = torch.bmm(encoded_mtref, encoded_mtsys.transpose(1, 2))
+            if self._scale_similarity:
+                # same scaling as DotProductSimilarity(scale_output=True)
+                similarity_matrix = similarity_matrix * math.sqrt(encoded_mtref.size(-1))
+        else:
+            similarity_matrix = self._matrix_attention(encoded_mtref, encoded_mtsys)
 
-        if score is not None:
-            loss = self._loss(pred, score)
-            self._metric(pred, score)
-            output_dict["loss"] = loss
+        # Shape: (batch_size, mtref_length, mtsys_length)
+        p2h_attention = masked_softmax(similarity_matrix, mtsys_mask)
+        # Shape: (batch_size, mtref_length, embedding_dim)
+        attended_mtsys = weighted_sum(encoded_mtsys, p2h_attention)
 
-        return output_dict
+        # Normalize over the mtref dimension of the untransposed matrix and transpose the
+        # result, instead of copying a contiguous transpose of the similarity matrix.
+        # Shape: (batch_size, mtsys_length, mtref_length)
+        h2p_attention = masked_softmax(similarity_matrix, mtref_mask_3d, dim=1).transpose(1, 2)
+        # Shape: (batch_size, mtsys_length, embedding_dim)
+        attended_mtref = weighted_sum(encoded_mtref, h2p_attention)
+        return attended_mtsys, attended_mtref
+
+    @staticmethod
+    def _encode_pair(encoder: Seq2SeqEncoder,
+                     mtref: torch.Tensor,
+                     mtsys: torch.Tensor,
+                     mtref_mask: torch.Tensor,
+                     mtsys_mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Runs ``encoder`` once over the mtref and mtsys batches stacked together, instead of once
+        per side.  Both sides are padded to the same length; with a mask, the pytorch RNN wrappers
+        pack the sequences by length, so the extra padding is not computed.
+        """
+        mtref_length, mtsys_length = mtref.size(1), mtsys.size(1)
+        max_length = max(mtref_length, mtsys_length)
+        inputs = torch.cat([torch.nn.functional.pad(mtref, [0, 0, 0, max_length - mtref_length]),
+                            torch.nn.functional.pad(mtsys, [0, 0, 0, max_length - mtsys_length])], dim=0)
+        mask = torch.cat([torch.nn.functional.pad(mtref_mask, [0, max_length - mtref_length]),
+                          torch.nn.functional.pad(mtsys_mask, [0, max_length - mtsys_length])], dim=0)
+        encoded_mtref, encoded_mtsys = encoder(inputs, mask).split(mtref.size(0), dim=0)
+        return encoded_mtref[:, :mtref_length], encoded_mtsys[:, :mtsys_length]
+
+    def _autocast(self, is_cuda: bool):
+        """
+        Returns the bfloat16 autocast context when mixed precision is enabled on GPU, and a
+        context that does nothing otherwise.
+        """
+        if self._mixed_precision and is_cuda:
+            return torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+        return contextlib.ExitStack()
 
+    def _project_enhanced(self, encoded: torch.Tensor, attended: torch.Tensor) -> torch.Tensor:
+        """
+        Computes ``self._projection_feedforward`` applied to the enhanced representation
+        ``[encoded, attended, encoded - attended, encoded * attended]``.  The weight of the first
+        linear layer is split into the four blocks that multiply each part of the concatenation,
+        and the ``encoded - attended`` block is folded into the other two, so the first layer
+        becomes three matmuls on ``(batch_size, length, modeldim*2)`` inputs.
+        """
+        # pylint: disable=protected-access
+        feedforward = self._projection_feedforward
+        first_layer = feedforward._linear_layers[0]
+        w_encoded, w_attended, w_diff, w_prod = first_layer.weight.chunk(4, dim=1)
+        output = (torch.nn.functional.linear(encoded, w_encoded + w_diff, first_layer.bias)
+                  + torch.nn.functional.linear(attended, w_attended - w_diff)
+                  + torch.nn.functional.linear(encoded * attended, w_prod))
+        layers = zip(feedforward._linear_layers, feedforward._activations, feedforward._dropout)
+        for i, (layer, activation, dropout) in enumerate(layers):
+            if i > 0:
+                output = layer(output)
+            output = dropout(activation(output))
+        return output
 
     def get_metrics(self, reset: bool = False) -> Dict[str, float]:
         return {'pearson': self._metric.get_metric(reset)}